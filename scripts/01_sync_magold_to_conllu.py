@@ -1,8 +1,11 @@
 from __future__ import annotations
 
+import argparse
+import pickle
 import re
+import sys
 from pathlib import Path
-from typing import Dict, Tuple, Optional, List
+from typing import Dict, Tuple, Optional, Iterator
 
 
 # ----------------------------
@@ -38,20 +41,83 @@ def format_feats(d: Dict[str, str]) -> str:
     return "|".join(f"{k}={d[k]}" for k in sorted(d.keys()))
 
 
-def parse_misc(misc: str) -> Dict[str, str]:
-    misc = (misc or "").strip()
-    if misc in ("", "_"):
-        return {}
+# gen/num/rat as whole FEATS keys (so "form_gen=" is left alone)
+_KV_RE = re.compile(r"(?<![^|])(gen|num|rat)=([^|]*)")
+
+
+def patch_feats(feats_str: str, new_gen: str, new_num: str, new_rat: str) -> str:
+    """
+    Set gen/num/rat directly in a raw FEATS string.
+    Existing values are replaced in place (original key order is kept),
+    missing keys are appended at the end.
+    Values are compared the way parse_feats reads them (last occurrence
+    wins); if none differs, feats_str is returned unchanged.
+    """
+    new_vals = {"gen": new_gen, "num": new_num, "rat": new_rat}
+    feats_str = feats_str or ""
+    body = feats_str.strip()
+    # keep any whitespace around the column as it was
+    lead = feats_str[:len(feats_str) - len(feats_str.lstrip())]
+    trail = feats_str[len(lead) + len(body):]
+    if body == "_":
+        body = ""
+
+    cur = {m.group(1): m.group(2) for m in _KV_RE.finditer(body)}
+    if all(cur.get(k) == v for k, v in new_vals.items()):
+        return feats_str
+
+    def _sub(m: "re.Match[str]") -> str:
+        return f"{m.group(1)}={new_vals[m.group(1)]}"
+
+    parts = [_KV_RE.sub(_sub, body)] if body else []
+    parts.extend(f"{k}={v}" for k, v in new_vals.items() if k not in cur)
+
+    return lead + ("|".join(parts) or "_") + trail
+
+
+def kv_needles(keys: Tuple[str, ...]) -> Tuple[Tuple[str, str], ...]:
+    # precomputed (key, "|key=") pairs for parse_kv
+    return tuple((k, f"|{k}=") for k in keys)
+
+
+def parse_kv(s: str, needles: Tuple[Tuple[str, str], ...]) -> Dict[str, str]:
+    """
+    Pull only the requested keys out of a raw "k=v|k=v" string (FEATS/MISC);
+    needles come from kv_needles. Each key is located with str.rfind and only
+    its value is sliced out, so no substrings are built for the other keys.
+    The last occurrence of a key wins.
+    """
+    s = "|" + (s or "").strip()
     d = {}
-    for part in misc.split("|"):
-        if "=" in part:
-            k, v = part.split("=", 1)
-            d[k] = v
+    for k, needle in needles:
+        i = s.rfind(needle)
+        if i < 0:
+            continue
+        i += len(needle)
+        j = s.find("|", i)
+        d[k] = s[i:] if j < 0 else s[i:j]
     return d
 
 
-def read_conllu_lines(path: Path) -> List[str]:
-    return path.read_text(encoding="utf-8").splitlines()
+def replace_col(line: str, col_index: int, new_val: str) -> str:
+    """
+    Return line with tab-separated column col_index replaced by new_val.
+    Only the tabs up to that column are scanned; the rest is spliced as-is.
+    """
+    start = 0
+    for _ in range(col_index):
+        start = line.index("\t", start) + 1
+    end = line.find("\t", start)
+    if end < 0:
+        return line[:start] + new_val
+    return line[:start] + new_val + line[end:]
+
+
+def read_conllu_lines(path: Path) -> Iterator[str]:
+    # stream the file; never hold the whole corpus as one string
+    with path.open("r", encoding="utf-8") as f:
+        for line in f:
+            yield line.rstrip("\n")
 
 
 # ----------------------------
@@ -60,61 +126,131 @@ def read_conllu_lines(path: Path) -> List[str]:
 # We only care about the analysis lines that start with "*"
 # Example:
 # *1.0000000 ... diac:ma$Akila ... gen:f ... num:p ... rat:i ...
-MAGOLD_ANALYSIS_RE = re.compile(r"^\*")
+#
+# Fields are whitespace-separated "key:value" tokens, e.g. "gen:f" or
+# "diac:ma$Akila". The file is scanned as raw bytes and only the values we
+# keep are decoded.
+
+# maps tab / CR / VT / FF to a plain space, so fields split on spaces only
+_WS_TO_SPACE = bytes.maketrans(b"\t\r\x0b\x0c", b"    ")
+
 
+def find_field(line: bytes, key: bytes) -> Optional[bytes]:
+    # line must already be run through _WS_TO_SPACE. key is passed with its
+    # leading space (b" gen:"), so "form_gen:m" never matches; the value runs
+    # to the next space
+    return line.partition(key)[2].partition(b" ")[0] or None
 
-def extract_field(line: str, key: str) -> Optional[str]:
-    # finds patterns like "gen:f" or "num:p" or "diac:ma$Akila"
-    m = re.search(rf"\b{re.escape(key)}:([^\s]+)", line)
-    return m.group(1) if m else None
 
+# (gen_map, num_map, rat_map): three parallel dicts over the same keys
+MagoldMaps = Tuple[Dict[str, str], Dict[str, str], Dict[str, str]]
 
-def build_magold_lookup(magold_path: Path) -> Dict[str, Tuple[str, str, str]]:
+
+def build_magold_lookup(magold_path: Path) -> MagoldMaps:
     """
-    Returns dict:
-      key (string) -> (gen, num, rat)
+    Returns three parallel dicts (gen_map, num_map, rat_map):
+      key (string) -> gen / num / rat
+    A key is always present in all three or in none.
     Keys we store:
       - diac
       - bw token (before "/") if present
     Values we store:
       - gen / num / rat (functional), NOT form_gen / form_num
+      - interned: the vocabulary is tiny ("m", "f", "s", "p", ...)
     """
-    lookup: Dict[str, Tuple[str, str, str]] = {}
+    gen_map: Dict[str, str] = {}
+    num_map: Dict[str, str] = {}
+    rat_map: Dict[str, str] = {}
 
-    for line in magold_path.read_text(encoding="utf-8", errors="replace").splitlines():
-        line = line.strip()
-        if not line or not MAGOLD_ANALYSIS_RE.match(line):
-            continue
+    with magold_path.open("rb") as f:
+        for line in f:
+            line = line.strip()
+            if not line.startswith(b"*"):
+                continue
+            line = line.translate(_WS_TO_SPACE)
 
-        gen = extract_field(line, "gen")
-        num = extract_field(line, "num")
-        rat = extract_field(line, "rat")
-        diac = extract_field(line, "diac")
-        bw_full = extract_field(line, "bw")  # e.g. ma$Akil/NOUN+a/...
-        bw_tok = None
-        if bw_full:
-            bw_tok = bw_full.split("/", 1)[0].lstrip("+")  # remove leading '+'
-
-        # Keep only usable values
-        if gen in (None, "na") or num in (None, "na") or rat in (None, "na"):
-            continue
+            gen = find_field(line, b" gen:")
+            num = find_field(line, b" num:")
+            rat = find_field(line, b" rat:")
 
-        val = (gen, num, rat)
+            # Keep only usable values
+            if gen in (None, b"na") or num in (None, b"na") or rat in (None, b"na"):
+                continue
 
-        # store diac key
-        if diac:
-            lookup[diac] = val
+            diac = find_field(line, b" diac:")
+            bw_full = find_field(line, b" bw:")  # e.g. ma$Akil/NOUN+a/...
+            bw_tok = None
+            if bw_full:
+                bw_tok = bw_full.split(b"/", 1)[0].lstrip(b"+")  # remove leading '+'
 
-        # store bw token key too
-        if bw_tok:
-            lookup[bw_tok] = val
+            gen_s = sys.intern(gen.decode("utf-8", errors="replace"))
+            num_s = sys.intern(num.decode("utf-8", errors="replace"))
+            rat_s = sys.intern(rat.decode("utf-8", errors="replace"))
 
-    return lookup
+            # store diac key, and bw token key too
+            for key in (diac, bw_tok):
+                if key:
+                    key_s = key.decode("utf-8", errors="replace")
+                    gen_map[key_s] = gen_s
+                    num_map[key_s] = num_s
+                    rat_map[key_s] = rat_s
+
+    return gen_map, num_map, rat_map
+
+
+# bump when build_magold_lookup changes what it stores
+MAGOLD_CACHE_VERSION = 1
+
+
+def load_or_build_magold(magold_path: Path, rebuild: bool = False) -> Tuple[MagoldMaps, bool]:
+    """
+    Load the MAGOLD maps from a pickle next to the source file
+    (e100.magold -> e100.lookup.pkl), or build and cache them.
+    The cache header records the source mtime/size, so any edit to the
+    MAGOLD file invalidates it.
+    Returns (maps, loaded_from_cache).
+    """
+    cache_path = magold_path.with_suffix(".lookup.pkl")
+    st = magold_path.stat()
+    header = (MAGOLD_CACHE_VERSION, st.st_mtime_ns, st.st_size)
+
+    if not rebuild and cache_path.exists():
+        try:
+            with cache_path.open("rb") as f:
+                if pickle.load(f) == header:
+                    maps = pickle.load(f)
+                    if (isinstance(maps, tuple) and len(maps) == 3
+                            and all(isinstance(m, dict) for m in maps)):
+                        return maps, True
+        except Exception:
+            pass  # unreadable / corrupt cache file: just rebuild it
+
+    maps = build_magold_lookup(magold_path)
+
+    # the cache is optional: a read-only data dir or full disk must not fail the run
+    tmp_path = cache_path.with_suffix(".tmp")
+    try:
+        with tmp_path.open("wb") as f:
+            pickle.dump(header, f, protocol=5)
+            pickle.dump(maps, f, protocol=5)
+        tmp_path.replace(cache_path)
+    except OSError as e:
+        print(f"WARNING: could not write MAGOLD cache {cache_path}: {e}")
+        try:
+            tmp_path.unlink(missing_ok=True)
+        except OSError:
+            pass
+
+    return maps, False
 
 
 # ----------------------------
 # Sync logic
 # ----------------------------
+# the only MISC keys the sync needs (see choose_conllu_key)
+_LOOKUP_MISC_NEEDLES = kv_needles(("surface_plus_bw", "surface_form_bw"))
+
+
 def choose_conllu_key(misc: Dict[str, str]) -> Optional[str]:
     # Best key first
     if "surface_plus_bw" in misc:
@@ -125,8 +261,20 @@ def choose_conllu_key(misc: Dict[str, str]) -> Optional[str]:
     return None
 
 
-def sync_conllu_with_magold(conllu_lines: List[str], mag_lookup: Dict[str, Tuple[str, str, str]]):
-    out: List[str] = []
+def sync_conllu_stream(
+    in_path: Path,
+    out_path: Path,
+    mag_lookup: MagoldMaps,
+    stable_sort: bool = False,
+):
+    """
+    Single pass: read CoNLL-U from in_path, sync gen/num/rat from MAGOLD,
+    write each line to out_path as soon as it is processed.
+    Updated FEATS keep their original key order unless stable_sort is set,
+    in which case they are re-serialized with sorted keys.
+    Returns (matched, updated, debug_hits).
+    """
+    gen_map, num_map, rat_map = mag_lookup
     matched = 0
     updated = 0
 
@@ -135,65 +283,96 @@ def sync_conllu_with_magold(conllu_lines: List[str], mag_lookup: Dict[str, Tuple
 
     debug_hits = []
 
-    for ln in conllu_lines:
-        if not ln.strip() or ln.startswith("#"):
-            out.append(ln)
-            continue
-
-        cols = ln.split("\t")
-        if len(cols) < 10:
-            out.append(ln)
-            continue
-
-        feats_str = cols[5]
-        misc_str = cols[9]
-
-        feats = parse_feats(feats_str)
-        misc = parse_misc(misc_str)
-
-        key = choose_conllu_key(misc)
-        if key and key in debug_targets:
-            debug_hits.append(f"[CONLLU] key={key} feats_before={feats_str} misc={misc_str}")
-
-        if not key:
-            out.append(ln)
-            continue
-
-        mag_val = mag_lookup.get(key)
-        if not mag_val:
-            out.append(ln)
-            continue
-
-        matched += 1
-        new_gen, new_num, new_rat = mag_val
-
-        # update only if changed (keeps counts meaningful)
-        changed = False
-        if feats.get("gen") != new_gen:
-            feats["gen"] = new_gen
-            changed = True
-        if feats.get("num") != new_num:
-            feats["num"] = new_num
-            changed = True
-        if feats.get("rat") != new_rat:
-            feats["rat"] = new_rat
-            changed = True
-
-        if changed:
-            updated += 1
-            cols[5] = format_feats(feats)
-            new_ln = "\t".join(cols)
-            out.append(new_ln)
-
-            if key in debug_targets:
-                debug_hits.append(f"[UPDATED] key={key} feats_after={cols[5]}")
-        else:
-            out.append(ln)
-
-    return out, matched, updated, debug_hits
+    with out_path.open("w", encoding="utf-8", newline="\n") as f:
+        for ln in read_conllu_lines(in_path):
+            # comments / blank lines / short rows pass through unchanged
+            if not ln or ln.startswith("#"):
+                f.write(ln)
+                f.write("\n")
+                continue
+
+            # CoNLL-U has exactly 10 columns; don't split past MISC
+            cols = ln.split("\t", 9)
+            if len(cols) < 10:
+                f.write(ln)
+                f.write("\n")
+                continue
+
+            misc_str = cols[9]
+
+            # fast path: most tokens carry no lookup key, so skip parsing entirely.
+            # One scan for the shared "surface_" prefix rejects nearly every
+            # token; the exact keys are only checked when it is present.
+            if "surface_" not in misc_str or (
+                "surface_plus_bw=" not in misc_str and "surface_form_bw=" not in misc_str
+            ):
+                f.write(ln)
+                f.write("\n")
+                continue
+
+            feats_str = cols[5]
+            misc = parse_kv(misc_str, _LOOKUP_MISC_NEEDLES)
+
+            key = choose_conllu_key(misc)
+            if key and key in debug_targets:
+                debug_hits.append(f"[CONLLU] key={key} feats_before={feats_str} misc={misc_str}")
+
+            new_gen = gen_map.get(key) if key else None
+            if new_gen is None:
+                f.write(ln)
+                f.write("\n")
+                continue
+
+            matched += 1
+            new_num = num_map[key]
+            new_rat = rat_map[key]
+
+            # update only if changed (keeps counts meaningful)
+            if stable_sort:
+                # FEATS are only needed once we know the token will be synced
+                feats = parse_feats(feats_str)
+                changed = False
+                if feats.get("gen") != new_gen:
+                    feats["gen"] = new_gen
+                    changed = True
+                if feats.get("num") != new_num:
+                    feats["num"] = new_num
+                    changed = True
+                if feats.get("rat") != new_rat:
+                    feats["rat"] = new_rat
+                    changed = True
+                new_feats = format_feats(feats) if changed else feats_str
+            else:
+                new_feats = patch_feats(feats_str, new_gen, new_num, new_rat)
+                changed = new_feats != feats_str
+
+            if changed:
+                updated += 1
+                ln = replace_col(ln, 5, new_feats)
+
+                if key in debug_targets:
+                    debug_hits.append(f"[UPDATED] key={key} feats_after={new_feats}")
+
+            f.write(ln)
+            f.write("\n")
+
+    return matched, updated, debug_hits
 
 
 def main() -> None:
+    ap = argparse.ArgumentParser(description="Sync gen/num/rat from MAGOLD into CoNLL-U FEATS.")
+    ap.add_argument(
+        "--stable-sort",
+        action="store_true",
+        help="re-serialize updated FEATS with sorted keys (diff-friendly, slower)",
+    )
+    ap.add_argument(
+        "--rebuild-cache",
+        action="store_true",
+        help="ignore the cached MAGOLD lookup and rebuild it from the .magold file",
+    )
+    args = ap.parse_args()
+
     for p in (CONLLU_IN, MAGOLD_IN):
         if not p.exists():
             raise FileNotFoundError(f"Missing file: {p}")
@@ -203,14 +382,11 @@ def main() -> None:
     print(f"MAGOLD_IN  : {MAGOLD_IN}")
     print(f"CONLLU_OUT : {CONLLU_OUT}")
 
-    conllu_lines = read_conllu_lines(CONLLU_IN)
-    mag_lookup = build_magold_lookup(MAGOLD_IN)
-
-    print(f"MAGOLD lookup size (keys): {len(mag_lookup)}")
+    mag_lookup, from_cache = load_or_build_magold(MAGOLD_IN, rebuild=args.rebuild_cache)
 
-    out_lines, matched, updated, debug_hits = sync_conllu_with_magold(conllu_lines, mag_lookup)
+    print(f"MAGOLD lookup size (keys): {len(mag_lookup[0])}" + (" (from cache)" if from_cache else ""))
 
-    CONLLU_OUT.write_text("\n".join(out_lines) + "\n", encoding="utf-8")
+    matched, updated, debug_hits = sync_conllu_stream(CONLLU_IN, CONLLU_OUT, mag_lookup, stable_sort=args.stable_sort)
 
     print("Wrote:", CONLLU_OUT)
     print("Tokens matched to MAGOLD (by key):", matched)
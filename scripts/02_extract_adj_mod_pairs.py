@@ -1,10 +1,16 @@
 
 from __future__ import annotations
 
+import argparse
 import csv
+import itertools
+import os
 import re
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from collections import namedtuple
 from pathlib import Path
-from typing import Dict, List, Tuple, Optional
+from typing import Dict, Iterable, Iterator, List, Tuple, Optional
 
 # ---------- Paths ----------
 BASE_DIR = Path("~/Desktop/ArabicAgreementSync").expanduser()
@@ -13,30 +19,40 @@ DATA_DIR = BASE_DIR / "data"
 CONLLU_IN = DATA_DIR / "e100.SYNC.conllu"   # <- input
 CSV_OUT   = DATA_DIR / "adj_mod_pairs.csv"  # <- output
 
+# CSV column order; rows are plain tuples in this order
+FIELDNAMES = [
+    "sent_idx","adj_id","adj_form","adj_lemma","adj_feats","adj_misc",
+    "head_id","head_form","head_lemma","head_feats","head_misc","deprel"
+]
+
 
 # ---------- Helpers ----------
-def parse_misc(misc: str) -> Dict[str, str]:
-    misc = (misc or "").strip()
-    if misc in ("", "_"):
-        return {}
-    out: Dict[str, str] = {}
-    for part in misc.split("|"):
-        if "=" in part:
-            k, v = part.split("=", 1)
-            out[k] = v
-    return out
+# one CoNLL-U token row; a tuple is far lighter than a per-token dict
+Token = namedtuple("Token", "id form lemma upos xpos feats_raw head deprel deps misc_raw")
+
+# deprel is interned when parsed, so this check is a pointer compare
+MOD = sys.intern("MOD")
 
-def parse_feats(feats: str) -> Dict[str, str]:
-    feats = (feats or "").strip()
-    if feats in ("", "_"):
-        return {}
+def kv_needles(keys: Tuple[str, ...]) -> Tuple[Tuple[str, str], ...]:
+    # precomputed (key, "|key=") pairs for parse_kv
+    return tuple((k, f"|{k}=") for k in keys)
+
+def parse_kv(s: str, needles: Tuple[Tuple[str, str], ...]) -> Dict[str, str]:
+    # only the requested MISC keys are sliced out (last occurrence wins)
+    s = "|" + (s or "").strip()
     out: Dict[str, str] = {}
-    for part in feats.split("|"):
-        if "=" in part:
-            k, v = part.split("=", 1)
-            out[k] = v
+    for k, needle in needles:
+        i = s.rfind(needle)
+        if i < 0:
+            continue
+        i += len(needle)
+        j = s.find("|", i)
+        out[k] = s[i:] if j < 0 else s[i:j]
     return out
 
+# the only MISC keys is_adj_token / is_noun_like look at
+_POS_MISC_NEEDLES = kv_needles(("bw", "mada", "kulick"))
+
 def is_adj_token(upos: str, xpos: str, misc: Dict[str, str]) -> bool:
     # Your data: UPOS/XPOS often "NOM", so we rely on MISC (bw/kulick/mada)
     bw = misc.get("bw", "")
@@ -67,109 +83,138 @@ def is_noun_like(misc: Dict[str, str], upos: str, xpos: str) -> bool:
     # (But still prefer bw/mada.)
     return False
 
-def read_conllu_sentences(path: Path) -> List[List[str]]:
-    sentences: List[List[str]] = []
+def read_conllu_sentences(path: Path) -> Iterator[str]:
+    # streams one raw sentence block (lines joined by "\n") at a time
     cur: List[str] = []
-    for line in path.read_text(encoding="utf-8").splitlines():
-        if line.strip() == "":
-            if cur:
-                sentences.append(cur)
-                cur = []
-            continue
-        cur.append(line)
+    with path.open("r", encoding="utf-8") as f:
+        for line in f:
+            line = line.rstrip("\n")
+            if line.strip() == "":
+                if cur:
+                    yield "\n".join(cur)
+                    cur = []
+                continue
+            cur.append(line)
     if cur:
-        sentences.append(cur)
-    return sentences
+        yield "\n".join(cur)
 
-def parse_token_line(line: str) -> Optional[Dict]:
+def parse_token_line(line: str) -> Optional[Token]:
     if line.startswith("#"):
         return None
-    cols = line.split("\t")
+    # CoNLL-U has exactly 10 columns; don't split past MISC
+    cols = line.split("\t", 9)
     if len(cols) < 10:
         return None
 
     tok_id = cols[0]
-    # skip multiword tokens / empty nodes
-    if "-" in tok_id or "." in tok_id:
+    # skip multiword tokens ("3-4") / empty nodes ("3.1"): both fail isdigit
+    if not tok_id.isdigit():
         return None
 
-    return {
-        "id": int(tok_id),
-        "form": cols[1],
-        "lemma": cols[2],
-        "upos": cols[3],
-        "xpos": cols[4],
-        "feats_raw": cols[5],
-        "head": int(cols[6]) if cols[6].isdigit() else 0,
-        "deprel": cols[7],
-        "deps": cols[8],
-        "misc_raw": cols[9],
-    }
+    try:
+        head = int(cols[6])
+    except ValueError:
+        head = 0
 
+    # positional: keyword construction is much slower on this per-token path
+    return Token(
+        int(tok_id), cols[1], cols[2], cols[3], cols[4],
+        cols[5], head, sys.intern(cols[7]), cols[8], cols[9],
+    )
 
-def main() -> None:
-    if not CONLLU_IN.exists():
-        raise FileNotFoundError(f"Missing input: {CONLLU_IN}")
 
-    sents = read_conllu_sentences(CONLLU_IN)
+def adj_mod_pairs(toks: List[Token]) -> Iterator[Tuple[Token, Token]]:
+    """Yield (dep, head) for every ADJ --MOD--> NOUN edge in a sentence."""
+    by_id: Optional[Dict[int, Token]] = None
+    for dep in toks:
+        if dep.deprel is not MOD:
+            continue
+
+        if not is_adj_token(dep.upos, dep.xpos, parse_kv(dep.misc_raw, _POS_MISC_NEEDLES)):
+            # Not an adjective modifier (e.g., NOUN->NOUN, NUM, etc.)
+            continue
+
+        # id -> token map is only needed once a sentence has a candidate
+        if by_id is None:
+            by_id = {t.id: t for t in toks}
+        head = by_id.get(dep.head)
+        if not head:
+            continue
 
-    rows: List[Dict[str, str]] = []
+        # optionally require noun head:
+        if not is_noun_like(parse_kv(head.misc_raw, _POS_MISC_NEEDLES), head.upos, head.xpos):
+            continue
 
-    for sent_i, sent_lines in enumerate(sents, start=1):
-        tokens: Dict[int, Dict] = {}
-        for ln in sent_lines:
+        yield dep, head
+
+
+def process_shard(shard: Iterable[Tuple[int, str]]) -> List[Tuple[str, ...]]:
+    """
+    Extract CSV rows from (sent_idx, raw sentence block) pairs.
+    Module-level so it can be shipped to worker processes.
+    """
+    rows: List[Tuple[str, ...]] = []
+    for sent_i, sent_block in shard:
+        toks: List[Token] = []
+        for ln in sent_block.split("\n"):
             t = parse_token_line(ln)
-            if not t:
-                continue
-            t["feats"] = parse_feats(t["feats_raw"])
-            t["misc"] = parse_misc(t["misc_raw"])
-            tokens[t["id"]] = t
+            if t:
+                toks.append(t)
 
-        for dep_id, dep in tokens.items():
-            if dep["deprel"] != "MOD":
-                continue
+        for dep, head in adj_mod_pairs(toks):
+            rows.append((
+                str(sent_i),
+                str(dep.id), dep.form, dep.lemma, dep.feats_raw, dep.misc_raw,
+                str(dep.head), head.form, head.lemma, head.feats_raw, head.misc_raw,
+                dep.deprel,
+            ))
+    return rows
 
-            if not is_adj_token(dep["upos"], dep["xpos"], dep["misc"]):
-                # Not an adjective modifier (e.g., NOUN->NOUN, NUM, etc.)
-                continue
 
-            head_id = dep["head"]
-            head = tokens.get(head_id)
-            if not head:
-                continue
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Extract ADJ->NOUN MOD pairs from a CoNLL-U file.")
+    ap.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="worker processes (0 = one per CPU); 1 runs in-process, best for small corpora",
+    )
+    args = ap.parse_args()
+    if args.jobs < 0:
+        ap.error("--jobs must be >= 0")
+    jobs = args.jobs or (os.cpu_count() or 1)
 
-            # optionally require noun head:
-            if not is_noun_like(head["misc"], head["upos"], head["xpos"]):
-                continue
+    if not CONLLU_IN.exists():
+        raise FileNotFoundError(f"Missing input: {CONLLU_IN}")
 
-            rows.append({
-                "sent_idx": str(sent_i),
-                "adj_id": str(dep_id),
-                "adj_form": dep["form"],
-                "adj_lemma": dep["lemma"],
-                "adj_feats": dep["feats_raw"],
-                "adj_misc": dep["misc_raw"],
-                "head_id": str(head_id),
-                "head_form": head["form"],
-                "head_lemma": head["lemma"],
-                "head_feats": head["feats_raw"],
-                "head_misc": head["misc_raw"],
-                "deprel": dep["deprel"],
-            })
+    n_sents = 0
+
+    def candidates() -> Iterator[Tuple[int, str]]:
+        nonlocal n_sents
+        for sent_i, sent_block in enumerate(read_conllu_sentences(CONLLU_IN), start=1):
+            n_sents = sent_i
+            # cheap pre-check on the raw block: no MOD deprel, no pairs to find
+            if "\tMOD\t" in sent_block:
+                yield sent_i, sent_block
+
+    if jobs == 1:
+        rows = process_shard(candidates())
+    else:
+        # sentences are independent: contiguous shards keep the output order
+        sents = list(candidates())
+        size = -(-len(sents) // jobs) or 1
+        shards = [sents[i:i + size] for i in range(0, len(sents), size)]
+        with ProcessPoolExecutor(max_workers=jobs) as ex:
+            rows = list(itertools.chain.from_iterable(ex.map(process_shard, shards)))
 
     # write CSV
     CSV_OUT.parent.mkdir(parents=True, exist_ok=True)
-    fieldnames = list(rows[0].keys()) if rows else [
-        "sent_idx","adj_id","adj_form","adj_lemma","adj_feats","adj_misc",
-        "head_id","head_form","head_lemma","head_feats","head_misc","deprel"
-    ]
     with CSV_OUT.open("w", encoding="utf-8", newline="") as f:
-        w = csv.DictWriter(f, fieldnames=fieldnames)
-        w.writeheader()
-        for r in rows:
-            w.writerow(r)
+        w = csv.writer(f)
+        w.writerow(FIELDNAMES)
+        w.writerows(rows)
 
-    print(f"Read sentences: {len(sents)}")
+    print(f"Read sentences: {n_sents}")
     print(f"Extracted ADJ→NOUN MOD pairs: {len(rows)}")
     print(f"Wrote: {CSV_OUT}")
 